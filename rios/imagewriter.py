@@ -23,8 +23,10 @@ Also contains the now-deprecated ImageWriter class
 from __future__ import print_function, division
 
 import os
-import math
+import threading
+from concurrent import futures
 
+import numpy
 from osgeo import gdal
 from osgeo import gdal_array
 
@@ -34,6 +36,17 @@ from . import calcstats
 from . import fileinfo
 
 
+# Built-in default creation options for particular drivers. These are used
+# when no other options are given, either explicitly on the controls object
+# or by the environment variables described in setDefaultDriver().
+builtinDriverOptions = {
+    'HFA': ['COMPRESSED=TRUE', 'IGNOREUTM=TRUE'],
+    'GTiff': ['TILED=YES', 'COMPRESS=LZW', 'INTERLEAVE=BAND',
+        'BIGTIFF=IF_SAFER'],
+    'KEA': []
+}
+
+
 def setDefaultDriver():
     """
     Sets some default values into global variables, defining
@@ -56,6 +69,8 @@ def setDefaultDriver():
     are intended to supercede the previous generic driver defaults. 
     
     If not otherwise supplied, the default is to use the HFA driver, with compression. 
+    Drivers listed in builtinDriverOptions (e.g. HFA and GTiff) get those
+    options by default, unless over-ridden by the environment variables.
     
     The code here is more complex than desirable, because it copes with legacy behaviour
     in the absence of the environment variables, and in the absence of the driver-specific
@@ -74,21 +89,19 @@ def setDefaultDriver():
         else:
             DEFAULTCREATIONOPTIONS = creationOptionsStr.split()
     else:
-        # To cope with the old behaviour, set something sensible for HFA, but not
-        # otherwise
-        if DEFAULTDRIVERNAME == "HFA":
-            DEFAULTCREATIONOPTIONS = ['COMPRESSED=TRUE', 'IGNOREUTM=TRUE']
-        else:
-            DEFAULTCREATIONOPTIONS = []
+        # Use the built-in defaults for the default driver, if we have any
+        DEFAULTCREATIONOPTIONS = list(builtinDriverOptions.get(
+            DEFAULTDRIVERNAME, []))
     
     # In the new paradigm, default creation options are specific to each driver, and
     # are loaded into a dictionary
     global dfltDriverOptions
+    # Start with the built-in defaults for each driver
     dfltDriverOptions = {}
-    # Start with the old generic default options, applied to the default driver
+    for (drvrName, options) in builtinDriverOptions.items():
+        dfltDriverOptions[drvrName] = list(options)
+    # The old generic default options apply to the default driver
     dfltDriverOptions[DEFAULTDRIVERNAME] = DEFAULTCREATIONOPTIONS
-    # Load some others which we wish to have as defaults, even if not set by the environment
-    dfltDriverOptions['GTiff'] = ['TILED=YES', 'COMPRESS=LZW', 'INTERLEAVE=BAND', 'BIGTIFF=IF_SAFER']
     # Now load any which are specified by environment variables, of the
     # form RIOS_DFLT_CREOPT_<drivername>
     driverOptVarPrefix = 'RIOS_DFLT_CREOPT_'
@@ -106,6 +119,28 @@ def setDefaultDriver():
 setDefaultDriver()
 
 
+# Cache of GDAL driver objects, keyed by driver short name
+driverCache = {}
+
+# Drivers which can write all bands of a band-sequential block in one call
+multiBandWriteDrivers = {'HFA', 'GTiff', 'ENVI', 'KEA'}
+
+
+def getDriver(driverName):
+    """
+    Return the GDAL driver object for the given short name. The lookup
+    is cached, to save repeatedly searching GDAL's driver registry when
+    creating many output files.
+
+    """
+    drvr = driverCache.get(driverName)
+    if drvr is None:
+        drvr = gdal.GetDriverByName(driverName)
+        if drvr is not None:
+            driverCache[driverName] = drvr
+    return drvr
+
+
 def writeBlock(gdalOutObjCache, blockDefn, outfiles, outputs, controls,
         workinggrid, singlePassMgr, timings):
     """
@@ -166,7 +201,7 @@ def openOutfile(symbolicName, filename, controls, arr, workinggrid):
     nullVal = controls.getOptionForImagename('statsIgnore', symbolicName)
     layernames = controls.getOptionForImagename('layernames', symbolicName)
 
-    drvr = gdal.GetDriverByName(driverName)
+    drvr = getDriver(driverName)
     ds = drvr.Create(filename, ncols, nrows, numBands, gdalDatatype,
         creationoptions)
     if ds is None:
@@ -398,18 +433,44 @@ def addAutoColorTable(filename, autoColorTableType):
 # WARNING
 
 
-def allnotNone(items):
-    for i in items:
-        if i is None:
-            return False
-    return True
+# Thread pool used by ImageWriter.close(background=True), along with the
+# set of outstanding Future objects from it. The pool is created on demand.
+# Building pyramids and statistics is heavy on memory and I/O, so by default
+# only one file is closed at a time. This can be changed before the first
+# background close. 
+BACKGROUND_CLOSE_WORKERS = 1
+backgroundClosePool = None
+backgroundCloseFutures = set()
+backgroundCloseLock = threading.Lock()
 
 
-def anynotNone(items):
-    for i in items:
-        if i is not None:
-            return True
-    return False
+def discardBackgroundClose(fut):
+    """
+    Called when a background close completes. Forget about it, unless it
+    failed, in which case it is kept so that waitOnBackgroundClose() can
+    re-raise its exception. 
+    
+    """
+    if not fut.cancelled() and fut.exception() is None:
+        with backgroundCloseLock:
+            backgroundCloseFutures.discard(fut)
+
+
+def waitOnBackgroundClose():
+    """
+    Wait until all ImageWriter.close() calls which were started with
+    background=True have completed. Any exception raised during the
+    background close is re-raised here.
+
+    """
+    with backgroundCloseLock:
+        futureList = list(backgroundCloseFutures)
+        backgroundCloseFutures.clear()
+
+    futures.wait(futureList)
+    for fut in futureList:
+        # Re-raises any exception from the background thread
+        fut.result()
 
 
 class ImageWriter(object):
@@ -450,7 +511,8 @@ class ImageWriter(object):
     def __init__(self, filename, drivername=DEFAULTDRIVERNAME, creationoptions=None,
             nbands=None, gdaldatatype=None, firstblock=None, 
             info=None, xsize=None, ysize=None, transform=None, projection=None,
-            windowxsize=None, windowysize=None, overlap=None):
+            windowxsize=None, windowysize=None, overlap=None,
+            writebatchrows=None):
         """
         filename is the output file to be created. Set driver to name of
         GDAL driver, default it HFA. creationoptions will also need to be
@@ -465,6 +527,12 @@ class ImageWriter(object):
         through ImageReader, generally create this class on the first iteration)
         or xsize, ysize, transform, projection, windowxsize, windowysize and overlap
         If you pass info, these other values will be determined from that
+
+        If writebatchrows is given, blocks passed to write() are held in
+        memory until that many complete rows of blocks have accumulated,
+        and are then written to the file in a single call. On some
+        filesystems, this is much faster than many small writes. Any
+        partial batch is written by close() or reset(). 
         
         """
         msg = "The ImageWriter class is now deprecated (v2.0.0)"
@@ -475,7 +543,7 @@ class ImageWriter(object):
             windowysize, overlap]
         if info is None:
             # check we have the other args
-            if not allnotNone(noninfoitems):
+            if not all(i is not None for i in noninfoitems):
                 msg = 'If not passing info object, must pass all other image info'
                 raise rioserrors.ParameterError(msg)
 
@@ -483,11 +551,12 @@ class ImageWriter(object):
             self.overlap = overlap
             self.windowxsize = windowxsize
             self.windowysize = windowysize
-            self.xtotalblocks = int(math.ceil(float(xsize) / windowxsize))
-            self.ytotalblocks = int(math.ceil(float(ysize) / windowysize))
+            # Integer ceiling division, avoiding any float round-off
+            self.xtotalblocks = (xsize + windowxsize - 1) // windowxsize
+            self.ytotalblocks = (ysize + windowysize - 1) // windowysize
             
         else:
-            if anynotNone(noninfoitems):
+            if any(i is not None for i in noninfoitems):
                 msg = 'Passed info object, but other args not None'
                 raise rioserrors.ParameterError(msg)
                     
@@ -499,11 +568,11 @@ class ImageWriter(object):
             self.overlap = info.getOverlapSize()
             (self.xtotalblocks, self.ytotalblocks) = info.getTotalBlocks()
 
-        if firstblock is None and not allnotNone([nbands, gdaldatatype]):
+        if firstblock is None and not all(i is not None for i in (nbands, gdaldatatype)):
             msg = 'if not passing firstblock, must pass nbands and gdaltype'
             raise rioserrors.ParameterError(msg)
                         
-        elif firstblock is not None and anynotNone([nbands, gdaldatatype]):
+        elif firstblock is not None and any(i is not None for i in (nbands, gdaldatatype)):
             msg = 'Must pass one either firstblock or nbands and gdaltype, not all of them'
             raise rioserrors.ParameterError(msg)
                         
@@ -529,17 +598,37 @@ class ImageWriter(object):
         self.deleteIfExisting(filename)
                     
         # Create the output dataset
-        driver = gdal.GetDriverByName(drivername)
-        self.ds = driver.Create(str(filename), xsize, ysize, nbands, gdaldatatype, creationoptions)
+        driver = getDriver(drivername)
+        self.ds = driver.Create(os.fspath(filename), xsize, ysize, nbands, gdaldatatype, creationoptions)
         if self.ds is None:
             msg = 'Unable to create output file %s' % filename
             raise rioserrors.ImageOpenError(msg)
                     
         self.ds.SetProjection(projection)
         self.ds.SetGeoTransform(transform)
-            
+
+        # If the file is laid out pixel-interleaved, we write all bands
+        # at once, in that same layout
+        interleave = self.ds.GetMetadataItem('INTERLEAVE', 'IMAGE_STRUCTURE')
+        self.pixelInterleaved = (interleave == 'PIXEL' and nbands > 1)
+
+        # For band-sequential files, these drivers can take all bands of
+        # a block in a single call, and lay them out in one pass
+        self.multiBandWrite = (drivername in multiBandWriteDrivers and
+            nbands > 1)
+
         # start writing at the first block
         self.blocknum = 0
+
+        # Pixel coords of every block, in the order write() visits them
+        self.blockCoords = [(xblock * self.windowxsize, yblock * self.windowysize)
+            for yblock in range(self.ytotalblocks)
+            for xblock in range(self.xtotalblocks)]
+
+        # Rows of blocks waiting to be written, as a list of
+        # (xcoord, ycoord, blockList) tuples
+        self.writebatchrows = writebatchrows
+        self.writeBuffer = []
             
         # if we have a first block then write it
         if firstblock is not None:
@@ -618,16 +707,22 @@ class ImageWriter(object):
         Writes the numpy block to the current location in the file,
         and updates the location pointer for next write
         """
+        if self.blocknum >= len(self.blockCoords):
+            raise rioserrors.OutsideImageBoundsError()
+        (xcoord, ycoord) = self.blockCoords[self.blocknum]
         
-        # convert the block to row/column
-        yblock = self.blocknum // self.xtotalblocks
-        xblock = self.blocknum % self.xtotalblocks
-        
-        # calculate the coords of this block in pixels
-        xcoord = xblock * self.windowxsize
-        ycoord = yblock * self.windowysize
-        
-        self.writeAt(block, xcoord, ycoord)
+        if self.writebatchrows is None:
+            self.writeAt(block, xcoord, ycoord)
+        else:
+            outblock = self.trimBlock(block, xcoord, ycoord)
+            if len(self.writeBuffer) == 0 or xcoord == 0:
+                self.writeBuffer.append((xcoord, ycoord, []))
+            # Take a copy, as the caller may re-use their array
+            self.writeBuffer[-1][2].append(outblock.copy())
+
+            rowComplete = (xcoord + self.windowxsize >= self.ds.RasterXSize)
+            if rowComplete and len(self.writeBuffer) >= self.writebatchrows:
+                self.flushWriteBuffer()
         
         # so next time we write the next block
         self.blocknum += 1
@@ -637,6 +732,14 @@ class ImageWriter(object):
         writes the numpy block to the specified pixel coords
         in the file
         """
+        outblock = self.trimBlock(block, xcoord, ycoord)
+        self.writeTrimmed(outblock, xcoord, ycoord)
+
+    def trimBlock(self, block, xcoord, ycoord):
+        """
+        Check that the given block is valid to write at the given
+        pixel coords, and return a view of it with the overlap removed
+        """
         # check they asked for block is valid
         brxcoord = xcoord + block.shape[-1] - self.overlap * 2
         brycoord = ycoord + block.shape[-2] - self.overlap * 2
@@ -648,33 +751,114 @@ class ImageWriter(object):
         if block.ndim != 3:
             raise rioserrors.ParameterError("Only 3 dimensional arrays are accepted now")
             
-        # write each band
-        for band in range(self.ds.RasterCount):
-        
-            bh = self.ds.GetRasterBand(band + 1)
+        # take off overlap if present. This is a view of all bands at once.
+        if self.overlap == 0:
+            outblock = block
+        else:
             slice_bottomMost = block.shape[-2] - self.overlap
             slice_rightMost = block.shape[-1] - self.overlap
-            
-            # take off overlap if present
-            outblock = block[band, self.overlap:slice_bottomMost, self.overlap:slice_rightMost]
-                
-            bh.WriteArray(outblock, xcoord, ycoord)
+            outblock = block[:, self.overlap:slice_bottomMost, self.overlap:slice_rightMost]
+        return outblock
+
+    def writeTrimmed(self, outblock, xcoord, ycoord):
+        """
+        Write the given block, which already has any overlap removed,
+        to the specified pixel coords in the file
+        """
+        gdalType = gdal_array.NumericTypeCodeToGDALTypeCode(outblock.dtype)
+        if self.pixelInterleaved and gdalType is not None:
+            # Re-arrange the (bands, y, x) block into (y, x, bands), and
+            # give GDAL the whole lot in one call, so it does not have to
+            # scatter each band separately into its interleaved layout
+            buf = numpy.ascontiguousarray(outblock.transpose(1, 2, 0))
+            (nrows, ncols, nbands) = buf.shape
+            itemsize = buf.itemsize
+            self.ds.WriteRaster(xcoord, ycoord, ncols, nrows, buf,
+                buf_type=gdalType, band_list=list(range(1, nbands + 1)),
+                buf_pixel_space=nbands * itemsize,
+                buf_line_space=nbands * itemsize * ncols,
+                buf_band_space=itemsize)
+        elif self.multiBandWrite and gdalType is not None:
+            # Give GDAL all bands in one band-sequential buffer
+            buf = numpy.ascontiguousarray(outblock)
+            (nbands, nrows, ncols) = buf.shape
+            self.ds.WriteRaster(xcoord, ycoord, ncols, nrows, buf,
+                buf_type=gdalType,
+                band_list=list(range(1, nbands + 1)))
+        else:
+            # write each band
+            for band in range(self.ds.RasterCount):
+                bh = self.ds.GetRasterBand(band + 1)
+                bh.WriteArray(outblock[band], xcoord, ycoord)
+
+    def flushWriteBuffer(self):
+        """
+        Write out any rows of blocks being held by write(). Each row
+        is joined into a single array, and consecutive rows of the same
+        extent are joined together, so they all go to GDAL in one call.
+        """
+        rows = [(xcoord, ycoord, numpy.concatenate(blockList, axis=2))
+            for (xcoord, ycoord, blockList) in self.writeBuffer]
+        self.writeBuffer = []
+
+        i = 0
+        while i < len(rows):
+            (xcoord, ycoord, rowArr) = rows[i]
+            rowGroup = [rowArr]
+            i += 1
+            while (i < len(rows) and rows[i][0] == xcoord and
+                    rows[i][2].shape[-1] == rowArr.shape[-1]):
+                rowGroup.append(rows[i][2])
+                i += 1
+            if len(rowGroup) > 1:
+                rowArr = numpy.concatenate(rowGroup, axis=1)
+            self.writeTrimmed(rowArr, xcoord, ycoord)
 
     def reset(self):
         """
         Resets the location pointer so that the next
         write() call writes to the start of the file again
         """
+        self.flushWriteBuffer()
         self.blocknum = 0
     
     def close(self, calcStats=False, statsIgnore=None, progress=None, omitPyramids=False,
             overviewLevels=calcstats.DEFAULT_OVERVIEWLEVELS,
             overviewMinDim=calcstats.DEFAULT_MINOVERVIEWDIM, 
             overviewAggType=None, autoColorTableType=rat.DEFAULT_AUTOCOLORTABLETYPE,
-            approx_ok=False):
+            approx_ok=False, background=False):
         """
         Closes the open dataset
+
+        If background is True, then the statistics, pyramids and closing
+        of the dataset are carried out in a separate thread, and this
+        returns immediately with a concurrent.futures.Future for that work.
+        This allows the caller to get on with computing the next file while
+        the overviews for this one are being built. Use the module function
+        waitOnBackgroundClose() to wait for all such closes to complete.
+
         """
+        self.flushWriteBuffer()
+
+        if background:
+            global backgroundClosePool
+            with backgroundCloseLock:
+                if backgroundClosePool is None:
+                    backgroundClosePool = futures.ThreadPoolExecutor(
+                        max_workers=BACKGROUND_CLOSE_WORKERS)
+                fut = backgroundClosePool.submit(self.close,
+                    calcStats=calcStats, statsIgnore=statsIgnore,
+                    progress=progress, omitPyramids=omitPyramids,
+                    overviewLevels=overviewLevels,
+                    overviewMinDim=overviewMinDim,
+                    overviewAggType=overviewAggType,
+                    autoColorTableType=autoColorTableType,
+                    approx_ok=approx_ok)
+                backgroundCloseFutures.add(fut)
+            # Outside the lock, as it runs immediately if already done
+            fut.add_done_callback(discardBackgroundClose)
+            return fut
+
         if statsIgnore is not None:
             # This also gets set inside addStatistics. That is a 
             # historical anomaly. This is the correct place to do it. 
@@ -84,6 +84,10 @@ Environment Variables
 |                                 | processing commands. Not generally required, but was            |
 |                                 | useful for initial testing.                                     |
 +---------------------------------+-----------------------------------------------------------------+
+|RIOS_JOBMGR_COMPRESS             | If 1, the subproc, PBS and SLURM job managers compress large    |
+|                                 | arrays in the pickles passed to and from sub-jobs. Requires     |
+|                                 | the zstandard package, wherever the sub-jobs run.               |
++---------------------------------+-----------------------------------------------------------------+
 
 """
 # This file is part of RIOS - Raster I/O Simplification
@@ -107,17 +111,27 @@ import os
 import sys
 import abc
 import subprocess
-import tempfile
+import uuid
+import re
 import time
+import threading
 import pickle
-try:
-    import cloudpickle
-except ImportError:
-    # If we don't have cloudpickle, then we can't do any jobmanager stuff,
-    # but continue as a dummy anyway, to avoid impacting anything else
-    cloudpickle = None
+import functools
+from concurrent import futures
 
 from .. import rioserrors
+from . import subproc as subprocmod
+
+# On Linux, the pipes to/from sub-processes can be enlarged from their
+# default of 64 KiB, so large pickles move in fewer, bigger chunks.
+# The fcntl constant only appeared in Python 3.10, so fall back to its value.
+PIPE_SIZE = 1024 * 1024
+F_SETPIPE_SZ = 1031
+try:
+    import fcntl
+    F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', F_SETPIPE_SZ)
+except ImportError:
+    fcntl = None
 
 
 class BlockAssociations(object):
@@ -172,12 +186,33 @@ class JobManager(object):
 
         startAllJobs()
     
+    A sub-class which sets concurrentStart must over-ride prepareOneJob() and
+    submitOneJob() instead of startOneJob(). 
+    
     A sub-class must also include a class attribute called jobMgrType, which has 
     string value, which is the name used to select this sub-class. 
     
     """
     __metaclass__ = abc.ABCMeta
     jobMgrType = None
+    # If True, startAllJobs() submits the jobs from a pool of threads, while 
+    # running the first job in the current process. Only suitable when 
+    # submitOneJob() is thread-safe. 
+    concurrentStart = False
+    # Dictionary of sub-classes, keyed by jobMgrType
+    registry = {}
+
+    def __init_subclass__(cls, **kwargs):
+        """
+        Register each sub-class by its jobMgrType, as it is defined. Only
+        a class which sets jobMgrType itself is registered, so a sub-class
+        of e.g. SubprocJobManager, which just inherits its jobMgrType, does
+        not replace it. 
+        """
+        super().__init_subclass__(**kwargs)
+        jobMgrType = cls.__dict__.get('jobMgrType')
+        if jobMgrType is not None:
+            JobManager.registry[jobMgrType] = cls
     
     def __init__(self, numSubJobs):
         """
@@ -186,6 +221,10 @@ class JobManager(object):
         rioserrors.deprecationWarning("The JobManager class is deprecated (v2.0.0)")
         self.numSubJobs = numSubJobs
         self.tempdir = '.'
+        # Compress the pickles passed to and from sub-jobs, if supported
+        self.compressPickles = (os.getenv('RIOS_JOBMGR_COMPRESS') == '1')
+        # Tuple of (userFunc, pickledBytes), see getPickledFunction()
+        self.pickledFunc = None
     
     def setTempdir(self, tempdir):
         """
@@ -220,34 +259,106 @@ class JobManager(object):
 
         jobInputs should be a list of JobInfo derived objects.
         
+        If the concurrentStart attribute is True, all the other jobs are
+        prepared first, and are then submitted from a pool of threads, so 
+        that the first job can be computed while they are being submitted. 
+        The preparation is done here, before the first job runs, because 
+        the jobs may share input objects which that job could modify. 
+        
         """
         jobIDlist = [None]
-        for inputs in jobInputs[1:]:
-                
-            jobID = self.startOneJob(function, inputs)
-            jobIDlist.append(jobID)
+        startPool = None
+        if self.concurrentStart and len(jobInputs) > 1:
+            preparedJobs = [self.prepareOneJob(function, inputs)
+                for inputs in jobInputs[1:]]
+            numThreads = min(8, len(preparedJobs))
+            startPool = futures.ThreadPoolExecutor(max_workers=numThreads)
+            startFutures = [startPool.submit(self.submitOneJob, preparedJob)
+                for preparedJob in preparedJobs]
+        else:
+            for inputs in jobInputs[1:]:
+                    
+                jobID = self.startOneJob(function, inputs)
+                jobIDlist.append(jobID)
         
-        # Run the first one here
-        inputs = jobInputs[0]
-        params = inputs.getFunctionParams()
-        function(*params)
-
-        jobIDlist[0] = inputs.getFunctionResult(params)
+        try:
+            # Run the first one here
+            inputs = jobInputs[0]
+            params = inputs.getFunctionParams()
+            function(*params)
+
+            jobIDlist[0] = inputs.getFunctionResult(params)
+
+            if startPool is not None:
+                # Re-raises any exception from submitting a job
+                jobIDlist.extend([fut.result() for fut in startFutures])
+        finally:
+            if startPool is not None:
+                # If anything failed, do not submit any more jobs
+                startPool.shutdown(cancel_futures=True)
 
         return jobIDlist
     
-    @abc.abstractmethod
+    def getPickledFunction(self, userFunc):
+        """
+        Return the user function pickled with cloudpickle. The same function
+        is used for every sub-job, so it is only pickled once for this 
+        JobManager, i.e. for one call to apply(). 
+        
+        It is not shared with other JobManager objects, because cloudpickle
+        takes a copy of any globals the function uses, from the main script, 
+        and these may be changed between calls to apply(). 
+        
+        """
+        if self.pickledFunc is None or self.pickledFunc[0] is not userFunc:
+            pickledBytes = getCloudpickle().dumps(userFunc,
+                protocol=subprocmod.PICKLE_PROTOCOL)
+            self.pickledFunc = (userFunc, pickledBytes)
+        return self.pickledFunc[1]
+
     def startOneJob(self, userFunc, jobInfo):
         """
         Start one job. Return a jobID object suitable for identifying the
         job, with all information required to wait for it, and 
         recover its output. This jobID is specific to the subclass. 
         
-        This is an abstract method, and must be over-ridden in a sub-class.
+        This must be over-ridden in a sub-class, unless it over-rides
+        prepareOneJob() and submitOneJob() instead, as this default 
+        implementation just calls those two in turn. 
 
         jobInfo should be a JobInfo derived object.        
 
         """
+        preparedJob = self.prepareOneJob(userFunc, jobInfo)
+        return self.submitOneJob(preparedJob)
+    
+    def prepareOneJob(self, userFunc, jobInfo):
+        """
+        The first stage of starting one job. Do everything which uses 
+        the job's inputs (e.g. pickling them), and return an object 
+        with everything which submitOneJob() needs to start it. This is 
+        always called from the main thread. 
+        
+        Must be over-ridden in a sub-class which does not over-ride 
+        startOneJob(). 
+
+        """
+        msg = "JobManager '{}' does not implement prepareOneJob()"
+        raise NotImplementedError(msg.format(self.jobMgrType))
+    
+    def submitOneJob(self, preparedJob):
+        """
+        The second stage of starting one job, given the object returned 
+        by prepareOneJob(). Submit the job, and return its jobID, as for
+        startOneJob(). If concurrentStart is True, this is called from a
+        pool of threads, so must be thread-safe. 
+        
+        Must be over-ridden in a sub-class which does not over-ride 
+        startOneJob(). 
+
+        """
+        msg = "JobManager '{}' does not implement submitOneJob()"
+        raise NotImplementedError(msg.format(self.jobMgrType))
     
     @abc.abstractmethod
     def waitOnJobs(self, jobIDlist):
@@ -291,18 +402,44 @@ class SubprocJobManager(JobManager):
     concurrently. If you have enough spare cores and memory to do that, then
     no problem, but if not, you may clog the system. 
     
+    The sub-processes are launched, and their pickled inputs written, from 
+    pools of threads, so all sub-processes receive their input concurrently, 
+    while the first job is computed in this process. The outputs 
+    are read back concurrently in the same way. 
+    
+    Note that new sub-processes are started for every block. The 
+    replacement for this class, computeWorkerKind=CW_SUBPROC (see 
+    :mod:`rios.computemanager`), keeps its worker processes running for 
+    the whole of apply(), so avoids this start-up cost. 
+    
     """
     jobMgrType = "subproc"
+    concurrentStart = True
+
+    def __init__(self, numSubJobs):
+        JobManager.__init__(self, numSubJobs)
+        self.ioPool = futures.ThreadPoolExecutor(max_workers=max(1, numSubJobs - 1))
+        self.inputFutures = []
+
+    @staticmethod
+    def feedInputs(proc, inputChunks):
+        """
+        Write the already pickled inputs to the sub-process's stdin, and 
+        close it. Run in a separate thread. 
+        """
+        subprocmod.writeChunks(proc.stdin, inputChunks)
+        proc.stdin.close()
     
-    def startOneJob(self, userFunc, jobInfo):
+    def prepareOneJob(self, userFunc, jobInfo):
         """
-        Start one job. We execute the rios_subproc.py command,
-        communicating via its stdin/stdout. We give it the pickled
-        function and all input objects, and we get back a pickled
-        outputs object. 
+        Pickle the function and all input objects for one job. Returns a
+        list of chunks of the pickle, ready to write to the job's stdin. 
+        The buffers are copied, as they are not written until after the
+        first job has started running, and it may change them. 
         
         """
         # If we don't have cloudpickle, we can't do anything anyway
+        cloudpickle = getCloudpickle()
         if cloudpickle is None:
             msg = "Jobmanager '{}' requires cloudpickle, which is unavailable"
             msg = msg.format(self.jobMgrType)
@@ -310,27 +447,46 @@ class SubprocJobManager(JobManager):
 
         jobInfo = jobInfo.prepareForPickling()
 
-        allInputs = (userFunc, jobInfo)
-        allInputsPickled = cloudpickle.dumps(allInputs)
+        allInputs = (self.getPickledFunction(userFunc), jobInfo)
+        inputChunks = subprocmod.dumpToChunks(allInputs,
+            dumps=cloudpickle.dumps, compress=self.compressPickles,
+            copyBuffers=True)
+        return inputChunks
 
+    def submitOneJob(self, inputChunks):
+        """
+        Start one job. We execute the rios_subproc.py command,
+        communicating via its stdin/stdout. We give it the pickled
+        function and all input objects, and we get back a pickled
+        outputs object. The input is written from the I/O thread pool. 
+        
+        """
         subproc = find_executable('rios_subproc.py')
 
         # make sure we use sys.executable - safer on Windows
         proc = subprocess.Popen([sys.executable, subproc], stdin=subprocess.PIPE,
             stdout=subprocess.PIPE)
-        proc.stdin.write(allInputsPickled)
+        enlargePipe(proc.stdin)
+        enlargePipe(proc.stdout)
+        fut = self.ioPool.submit(self.feedInputs, proc, inputChunks)
+        self.inputFutures.append(fut)
 
         return proc
     
     def waitOnJobs(self, jobIDlist):
         """
         Wait until all the jobs in the given list have completed. This
-        implementation doesn't wait at all, because the subprocesses may
-        block on writing their output to the stdout pipe. So, we do  
-        nothing here, and actually wait on the read of the stdout from
-        the subprocesses. 
+        implementation doesn't wait for the jobs, because the subprocesses may
+        block on writing their output to the stdout pipe. So, we only wait
+        until all their inputs have been written, and actually wait on the 
+        read of the stdout from the subprocesses. 
         
         """
+        inputFutures = self.inputFutures
+        self.inputFutures = []
+        for fut in inputFutures:
+            # Re-raises any exception from writing the inputs
+            fut.result()
 
     def gatherAllOutputs(self, jobIDlist):
         """
@@ -340,24 +496,38 @@ class SubprocJobManager(JobManager):
         in the current process. 
         
         """
-        outputBlocksList = [jobIDlist[0]]
-        for proc in jobIDlist[1:]:
-            pickledOutput = proc.stdout.read()
-            outputObj = pickle.loads(pickledOutput)
-            outputBlocksList.append(outputObj)
+        stdoutList = [proc.stdout for proc in jobIDlist[1:]]
+        outputObjList = self.ioPool.map(subprocmod.loadWithBuffers, stdoutList)
+        outputBlocksList = [jobIDlist[0]] + list(outputObjList)
         return outputBlocksList
 
 
+class BatchJobHandle(object):
+    """
+    Identifies one job submitted to a batch queue (PBS or SLURM), as
+    returned by startOneJob(). Holds the queue's job ID string, and the 
+    names of the job's outputs file and log file. 
+    
+    """
+    __slots__ = ('jobID', 'outputsfile', 'logfile')
+
+    def __init__(self, jobID, outputsfile, logfile):
+        self.jobID = jobID
+        self.outputsfile = outputsfile
+        self.logfile = logfile
+
+
 class PbsJobManager(JobManager):
     """
     Use PBS to run individual jobs
     
     """
     jobMgrType = "pbs"
+    concurrentStart = True
     
-    def startOneJob(self, userFunc, jobInfo):
+    def prepareOneJob(self, userFunc, jobInfo):
         """
-        Start one job. We create a shell script to submit to a PBS batch queue.
+        Prepare one job. We create a shell script to submit to a PBS batch queue.
         When executed, the job will execute the rios_subproc.py command, giving
         it the names of two pickle files. The first is the pickle of all inputs
         (including the function), and the second is where it will write the 
@@ -368,8 +538,12 @@ class PbsJobManager(JobManager):
         amount of memory or walltime for each job, which will otherwise be
         defaulted by PBS. 
         
+        Returns a tuple of the names of the script, outputs and log files, 
+        for submitOneJob(). 
+        
         """
         # If we don't have cloudpickle, we can't do anything anyway
+        cloudpickle = getCloudpickle()
         if cloudpickle is None:
             msg = "Jobmanager '{}' requires cloudpickle, which is unavailable"
             msg = msg.format(self.jobMgrType)
@@ -377,14 +551,10 @@ class PbsJobManager(JobManager):
 
         jobInfo = jobInfo.prepareForPickling()
 
-        allInputs = (userFunc, jobInfo)
-        allInputsPickled = cloudpickle.dumps(allInputs)
+        allInputs = (self.getPickledFunction(userFunc), jobInfo)
         
-        (fd, inputsfile) = tempfile.mkstemp(prefix='rios_pbsin_', dir=self.tempdir, suffix='.tmp')
-        os.close(fd)
-        outputsfile = inputsfile.replace('pbsin', 'pbsout')
-        scriptfile = inputsfile.replace('pbsin', 'pbs').replace('.tmp', '.sh')
-        logfile = outputsfile.replace('.tmp', '.log')
+        (inputsfile, outputsfile, scriptfile, logfile) = makeJobFilenames(
+            self.tempdir, 'pbs', '.sh')
         
         qsubOptions = os.getenv('RIOS_PBSJOBMGR_QSUBOPTIONS')
         
@@ -402,8 +572,21 @@ class PbsJobManager(JobManager):
         scriptCmdList.append("rios_subproc.py %s %s"%(inputsfile, outputsfile))
         scriptStr = '\n'.join(scriptCmdList)
         
-        open(scriptfile, 'w').write(scriptStr + '\n')
-        open(inputsfile, 'wb').write(allInputsPickled)
+        with open(scriptfile, 'w') as f:
+            f.write(scriptStr + '\n')
+        with open(inputsfile, 'wb') as f:
+            subprocmod.dumpWithBuffers(allInputs, f, dumps=cloudpickle.dumps,
+                compress=self.compressPickles)
+
+        return (scriptfile, outputsfile, logfile)
+
+    def submitOneJob(self, preparedJob):
+        """
+        Submit one job prepared by prepareOneJob(), using qsub. Returns a 
+        BatchJobHandle for the job. 
+        
+        """
+        (scriptfile, outputsfile, logfile) = preparedJob
         
         submitCmdWords = ["qsub", scriptfile]
         proc = subprocess.Popen(submitCmdWords, stdout=subprocess.PIPE, 
@@ -424,12 +607,12 @@ class PbsJobManager(JobManager):
             msg = "Error from qsub. Message:\n" + stderr
             raise rioserrors.JobMgrError(msg)
         
-        return (pbsJobID, outputsfile, logfile)
+        return BatchJobHandle(pbsJobID, outputsfile, logfile)
     
     def waitOnJobs(self, jobIDlist):
         """
         Wait until all jobs in the given list have completed. The jobID values
-        are tuples whose first element is a PBS job id string. We poll the PBS 
+        are BatchJobHandle objects, holding the PBS job id string. We poll the PBS 
         queue until none of them are left in the queue, and then return. 
         
         Note that this also assumes the technique used by the default startAllJobs()
@@ -438,31 +621,19 @@ class PbsJobManager(JobManager):
         that job, but on all the rest. 
         
         Returns only when all the listed jobID strings are no longer found in the
-        PBS queue. Currently has no time-out, although perhaps it should. 
+        PBS queue (or are shown as completed). Currently has no time-out, although 
+        perhaps it should. 
         
-        """
-        allFinished = False
+        The polling is done by the shared pbsQstatPoller, so that if several
+        PbsJobManager objects are waiting at once, they share a single qstat
+        command for all their jobs. See QstatPoller for details. 
         
+        """
         # Extract the actual PBS job ID strings, skipping the first element. 
         # Express as a set, for efficiency later on
-        pbsJobIdSet = set([t[0] for t in jobIDlist[1:]])
+        pbsJobIdSet = set([h.jobID for h in jobIDlist[1:]])
         
-        while not allFinished:
-            qstatCmd = ["qstat"]
-            proc = subprocess.Popen(qstatCmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                universal_newlines=True)
-            (stdout, stderr) = proc.communicate()
-            
-            stdoutLines = [line for line in stdout.split('\n') if len(line) > 0]   # No blank lines
-            # Skip header lines, and grab first word on each line, which is jobID
-            qstatJobIDlist = [line.split()[0] for line in stdoutLines[2:]]
-            qstatJobIDset = set(qstatJobIDlist)
-            
-            allFinished = pbsJobIdSet.isdisjoint(qstatJobIDset)
-            
-            if not allFinished:
-                # Sleep for a bit before checking again
-                time.sleep(60)
+        pbsQstatPoller.wait(pbsJobIdSet)
     
     def gatherAllOutputs(self, jobIDlist):
         """
@@ -471,38 +642,177 @@ class PbsJobManager(JobManager):
         jobIDlist is actually an outputs object, from running the first sub-array
         in the current process. 
         
-        The jobIDlist is a list of tuples whose second element is the name of 
-        the output file containing the pickled outputs object. 
+        The rest of jobIDlist are BatchJobHandle objects, which give the name
+        of the output file containing the pickled outputs object. 
         
         """
         outputBlocksList = [jobIDlist[0]]
-        for (jobID, outputsfile, logfile) in jobIDlist[1:]:
-            try:
-                pickledOutput = open(outputsfile, 'rb').read()
-                outputObj = pickle.loads(pickledOutput)
-                os.remove(outputsfile)
-            except Exception as e:
-                logfileContents = 'No logfile found'
-                if os.path.exists(logfile):
-                    logfileContents = open(logfile).read()
-                msg = ("Error collecting output from PBS sub-job. Exception message:\n" + str(e) +
-                    "\nPBS Logfile:\n" + logfileContents)
-                raise rioserrors.JobMgrError(msg)
-            outputBlocksList.append(outputObj)
-            os.remove(logfile)
+        outputBlocksList.extend(readAllJobOutputs(jobIDlist[1:], 'PBS'))
         return outputBlocksList
         
     
+# Matches the jobID (first word) and state (fifth word) of each line of 
+# qstat output
+QSTAT_LINE_RE = re.compile(rb'^(\S+)(?:[ \t]+\S+){3}[ \t]+(\S+)', re.MULTILINE)
+
+
+def qstatOutstanding(pbsJobIdList):
+    """
+    Run qstat on the given list of PBS job ID strings, and return the 
+    set of those which are still in the queue, and not completed. 
+    Raises JobMgrError if qstat fails. 
+    
+    """
+    # Ask only about the given jobs. Those which have left the queue 
+    # are reported on stderr, and make qstat exit with an error. Any
+    # error message which does not name one of our jobs means that 
+    # qstat itself failed (e.g. could not contact the server), so we 
+    # cannot tell which jobs are finished. 
+    qstatCmd = ["qstat"] + list(pbsJobIdList)
+    proc = subprocess.Popen(qstatCmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (stdout, stderr) = proc.communicate()
+    if proc.returncode != 0:
+        errLines = stderr.decode(errors='replace').splitlines()
+        otherErrors = [line for line in errLines if len(line.strip()) > 0 and
+            not any(jobID in line for jobID in pbsJobIdList)]
+        if len(otherErrors) > 0:
+            msg = "qstat failed. Message:\n" + '\n'.join(otherErrors)
+            raise rioserrors.JobMgrError(msg)
+    
+    # Skip the two header lines, and take the jobID and state of each line. 
+    # Completed jobs may still be listed. Only the jobIDs are decoded. 
+    qstatJobIDset = set()
+    for (jobID, state) in QSTAT_LINE_RE.findall(stdout)[2:]:
+        if state not in (b'C', b'F'):
+            qstatJobIDset.add(jobID.decode())
+    
+    return qstatJobIDset & set(pbsJobIdList)
+
+
+class QstatWaiter(object):
+    """
+    One caller of QstatPoller.wait(). Holds the set of PBS job ID strings
+    it is waiting on, and any exception which stopped the polling for it. 
+    
+    """
+    __slots__ = ('pbsJobIdSet', 'error')
+
+    def __init__(self, pbsJobIdSet):
+        self.pbsJobIdSet = pbsJobIdSet
+        self.error = None
+
+
+class QstatPoller(object):
+    """
+    Poll PBS for the state of all jobs being waited on in this process, 
+    from a single background thread. Each waiting caller registers its
+    job IDs with wait(), and the thread runs one qstat for the union of 
+    all of them, rather than each caller running its own. 
+    
+    The interval between polls starts at minInterval seconds, growing 
+    to a maximum of maxInterval seconds, so that we notice promptly when 
+    short jobs finish. It starts again from the beginning whenever new jobs 
+    are registered. The thread exits when there is nothing left to wait for. 
+    
+    If qstat fails, the error is given to each caller still waiting at 
+    the time, on its own QstatWaiter, so that a later caller starting a 
+    new thread cannot hide it. 
+    
+    """
+    threadName = "rios-qstat-poller"
+
+    def __init__(self, minInterval=2, maxInterval=60):
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.condition = threading.Condition()
+        self.outstanding = set()
+        self.waiters = set()
+        self.thread = None
+        self.pollNum = 0
+
+    def wait(self, pbsJobIdSet):
+        """
+        Wait until none of the given PBS job ID strings are left in the 
+        queue. Raises JobMgrError if polling fails. 
+        
+        """
+        if len(pbsJobIdSet) == 0:
+            return
+
+        waiter = QstatWaiter(pbsJobIdSet)
+        with self.condition:
+            self.waiters.add(waiter)
+            self.outstanding |= pbsJobIdSet
+            self.pollNum = 0
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                    name=self.threadName, daemon=True)
+                self.thread.start()
+
+            try:
+                while (waiter.error is None and 
+                        not pbsJobIdSet.isdisjoint(self.outstanding)):
+                    self.condition.wait()
+            finally:
+                self.waiters.discard(waiter)
+
+        if waiter.error is not None:
+            msg = "Error polling PBS queue: {}".format(waiter.error)
+            raise rioserrors.JobMgrError(msg)
+
+    def run(self):
+        """
+        Main loop of the polling thread
+        """
+        while True:
+            with self.condition:
+                if len(self.outstanding) == 0:
+                    self.thread = None
+                    return
+                pbsJobIdList = sorted(self.outstanding)
+
+            try:
+                remaining = qstatOutstanding(pbsJobIdList)
+            except Exception as e:
+                with self.condition:
+                    # Only those whose jobs are not yet known to be finished
+                    for waiter in self.waiters:
+                        if not waiter.pbsJobIdSet.isdisjoint(self.outstanding):
+                            waiter.error = e
+                    self.outstanding.clear()
+                    self.thread = None
+                    self.condition.notify_all()
+                return
+
+            with self.condition:
+                self.outstanding -= (set(pbsJobIdList) - remaining)
+                self.condition.notify_all()
+                if len(self.outstanding) == 0:
+                    self.thread = None
+                    return
+                sleepTime = min(self.maxInterval,
+                    self.minInterval * 1.5 ** self.pollNum)
+                self.pollNum += 1
+
+            # Sleep for a bit before checking again
+            time.sleep(sleepTime)
+
+
+# The single poller shared by all PbsJobManager objects
+pbsQstatPoller = QstatPoller()
+
+
 class SlurmJobManager(JobManager):
     """
     Use SLURM to run individual jobs
     
     """
     jobMgrType = "slurm"
+    concurrentStart = True
 
-    def startOneJob(self, userFunc, jobInfo):
+    def prepareOneJob(self, userFunc, jobInfo):
         """
-        Start one job. We create a shell script to submit to a SLURM batch queue.
+        Prepare one job. We create a shell script to submit to a SLURM batch queue.
         When executed, the job will execute the rios_subproc.py command, giving
         it the names of two pickle files. The first is the pickle of all inputs
         (including the function), and the second is where it will write the 
@@ -513,8 +823,12 @@ class SlurmJobManager(JobManager):
         amount of memory or walltime for each job, which will otherwise be
         defaulted by SLURM. 
         
+        Returns a tuple of the names of the script, outputs and log files, 
+        for submitOneJob(). 
+        
         """
         # If we don't have cloudpickle, we can't do anything anyway
+        cloudpickle = getCloudpickle()
         if cloudpickle is None:
             msg = "Jobmanager '{}' requires cloudpickle, which is unavailable"
             msg = msg.format(self.jobMgrType)
@@ -522,14 +836,10 @@ class SlurmJobManager(JobManager):
 
         jobInfo = jobInfo.prepareForPickling()
 
-        allInputs = (userFunc, jobInfo)
-        allInputsPickled = cloudpickle.dumps(allInputs)
+        allInputs = (self.getPickledFunction(userFunc), jobInfo)
         
-        (fd, inputsfile) = tempfile.mkstemp(prefix='rios_slurmin_', dir=self.tempdir, suffix='.tmp')
-        os.close(fd)
-        outputsfile = inputsfile.replace('slurmin', 'slurmout')
-        scriptfile = inputsfile.replace('slurmin', 'slurm').replace('.tmp', '.sl')
-        logfile = outputsfile.replace('.tmp', '.log')
+        (inputsfile, outputsfile, scriptfile, logfile) = makeJobFilenames(
+            self.tempdir, 'slurm', '.sl')
         
         sbatchOptions = os.getenv('RIOS_SLURMJOBMGR_SBATCHOPTIONS')
         
@@ -548,8 +858,21 @@ class SlurmJobManager(JobManager):
         scriptCmdList.append("rios_subproc.py %s %s"%(inputsfile, outputsfile))
         scriptStr = '\n'.join(scriptCmdList)
         
-        open(scriptfile, 'w').write(scriptStr + '\n')
-        open(inputsfile, 'wb').write(allInputsPickled)
+        with open(scriptfile, 'w') as f:
+            f.write(scriptStr + '\n')
+        with open(inputsfile, 'wb') as f:
+            subprocmod.dumpWithBuffers(allInputs, f, dumps=cloudpickle.dumps,
+                compress=self.compressPickles)
+
+        return (scriptfile, outputsfile, logfile)
+
+    def submitOneJob(self, preparedJob):
+        """
+        Submit one job prepared by prepareOneJob(), using sbatch. Returns a 
+        BatchJobHandle for the job. 
+        
+        """
+        (scriptfile, outputsfile, logfile) = preparedJob
         
         submitCmdWords = ["sbatch", scriptfile]
         proc = subprocess.Popen(submitCmdWords, stdout=subprocess.PIPE, 
@@ -575,12 +898,12 @@ class SlurmJobManager(JobManager):
             msg = "Error from sbatch. Message:\n" + stderr
             raise rioserrors.JobMgrError(msg)
         
-        return (slurmJobID, outputsfile, logfile)
+        return BatchJobHandle(slurmJobID, outputsfile, logfile)
     
     def waitOnJobs(self, jobIDlist):
         """
         Wait until all jobs in the given list have completed. The jobID values
-        are tuples whose first element is a SLURM job id string. We poll the SLURM 
+        are BatchJobHandle objects, holding the SLURM job id string. We poll the SLURM 
         queue until none of them are left in the queue, and then return. 
         
         Note that this also assumes the technique used by the default startAllJobs()
@@ -596,7 +919,7 @@ class SlurmJobManager(JobManager):
         
         # Extract the actual SLURM job ID strings, skipping the first element. 
         # Express as a set, for efficiency later on
-        slurmJobIdSet = set([t[0] for t in jobIDlist[1:]])
+        slurmJobIdSet = set([h.jobID for h in jobIDlist[1:]])
         
         while not allFinished:
             squeueCmd = ["squeue", "--noheader"]
@@ -622,28 +945,113 @@ class SlurmJobManager(JobManager):
         jobIDlist is actually an outputs object, from running the first sub-array
         in the current process. 
         
-        The jobIDlist is a list of tuples whose second element is the name of 
-        the output file containing the pickled outputs object. 
+        The rest of jobIDlist are BatchJobHandle objects, which give the name
+        of the output file containing the pickled outputs object. 
         
         """
         outputBlocksList = [jobIDlist[0]]
-        for (jobID, outputsfile, logfile) in jobIDlist[1:]:
-            try:
-                pickledOutput = open(outputsfile, 'rb').read()
-                outputObj = pickle.loads(pickledOutput)
-                os.remove(outputsfile)
-            except Exception as e:
-                logfileContents = 'No logfile found'
-                if os.path.exists(logfile):
-                    logfileContents = open(logfile).read()
-                msg = ("Error collecting output from SLURM sub-job. Exception message:\n" + str(e) +
-                    "\nSLURM Logfile:\n" + logfileContents)
-                raise rioserrors.JobMgrError(msg)
-            outputBlocksList.append(outputObj)
-            os.remove(logfile)
+        outputBlocksList.extend(readAllJobOutputs(jobIDlist[1:], 'SLURM'))
         return outputBlocksList
 
 
+@functools.lru_cache(maxsize=None)
+def getCloudpickle():
+    """
+    Return the cloudpickle module, or None if it is unavailable. It is
+    imported on first use, rather than when this module is imported, as 
+    it is slow to import and only needed by some of the job managers. 
+    If we don't have it, then we can't do any jobmanager stuff, but 
+    carry on as a dummy anyway, to avoid impacting anything else. 
+    
+    """
+    try:
+        import cloudpickle
+    except ImportError:
+        cloudpickle = None
+    return cloudpickle
+
+
+def readJobOutput(outputsfile, logfile, kind):
+    """
+    Read the pickled outputs object written by one batch queue job, of 
+    the given kind (e.g. 'PBS'), and remove its outputs and log files. 
+    If the outputs cannot be read, raise JobMgrError, including the 
+    contents of the job's log file. 
+    
+    The outputs file is removed straight after reading it. Except on 
+    Windows, its arrays are still backed by a mapping of the file, which 
+    stays valid after the removal. See subproc.loadFileWithBuffers(). 
+    
+    """
+    try:
+        outputObj = subprocmod.loadFileWithBuffers(outputsfile)
+        os.remove(outputsfile)
+    except Exception as e:
+        logfileContents = 'No logfile found'
+        if os.path.exists(logfile):
+            with open(logfile) as f:
+                logfileContents = f.read()
+        msg = ("Error collecting output from {} sub-job. Exception message:\n".format(kind) +
+            str(e) + "\n{} Logfile:\n".format(kind) + logfileContents)
+        raise rioserrors.JobMgrError(msg)
+    os.remove(logfile)
+    return outputObj
+
+
+def readAllJobOutputs(jobIDs, kind):
+    """
+    Read the outputs of all the given batch queue jobs, using readJobOutput().
+    The jobIDs are BatchJobHandle objects. The files are read 
+    from a pool of threads, as each read is mostly waiting on the (often 
+    networked) filesystem. Returns a list of the outputs objects, in the 
+    same order as jobIDs. 
+    
+    """
+    outputObjList = []
+    if len(jobIDs) > 0:
+        numThreads = min(32, len(jobIDs))
+        with futures.ThreadPoolExecutor(max_workers=numThreads) as pool:
+            outputObjList = list(pool.map(readJobOutput,
+                [h.outputsfile for h in jobIDs],
+                [h.logfile for h in jobIDs],
+                [kind] * len(jobIDs)))
+    return outputObjList
+
+
+def makeJobFilenames(tempdir, kind, scriptSuffix):
+    """
+    Make the names of the files used by one batch queue job, of the given
+    kind (e.g. 'pbs'). Returns a tuple of
+        (inputsfile, outputsfile, scriptfile, logfile)
+    
+    The names share a unique tag, so unlike tempfile.mkstemp(), nothing
+    needs to be created on disk to reserve them. This saves metadata
+    operations, which are slow on the shared filesystems typical of clusters. 
+    
+    """
+    tag = "{}_{}".format(os.getpid(), uuid.uuid4().hex)
+    inputsfile = os.path.join(tempdir, "rios_{}in_{}.tmp".format(kind, tag))
+    outputsfile = os.path.join(tempdir, "rios_{}out_{}.tmp".format(kind, tag))
+    scriptfile = os.path.join(tempdir, "rios_{}_{}{}".format(kind, tag, scriptSuffix))
+    logfile = os.path.join(tempdir, "rios_{}out_{}.log".format(kind, tag))
+    return (inputsfile, outputsfile, scriptfile, logfile)
+
+
+def enlargePipe(pipe):
+    """
+    Try to increase the kernel buffer size of the given pipe, to
+    PIPE_SIZE bytes. This is only possible on Linux, and may be limited
+    by /proc/sys/fs/pipe-max-size, so any failure is silently ignored,
+    leaving the pipe at its default size. 
+    
+    """
+    if fcntl is not None and sys.platform.startswith('linux'):
+        try:
+            fcntl.fcntl(pipe.fileno(), F_SETPIPE_SZ, PIPE_SIZE)
+        except OSError:
+            pass
+
+
 def find_executable(executable):
     """
     Our own version of distutils.spawn.find_executable that finds 
@@ -710,6 +1118,7 @@ class MpiJobManager(JobManager):
 
         """
         # If we don't have cloudpickle, we can't do anything anyway
+        cloudpickle = getCloudpickle()
         if cloudpickle is None:
             msg = "Jobmanager '{}' requires cloudpickle, which is unavailable"
             msg = msg.format(self.jobMgrType)
@@ -863,17 +1272,12 @@ def getJobManagerClassByType(jobMgrType):
     given. 
     
     All sub-classes of JobManager will be searched for the 
-    given jobMgrType string. 
+    given jobMgrType string. Returns None if there is no such sub-class. 
         
     """
     rioserrors.deprecationWarning("The JobManager class is deprecated (v2.0.0)")
 
-    jobMgr = None
-    subClasses = JobManager.__subclasses__()
-    for c in subClasses:
-        if c.jobMgrType == jobMgrType:
-            jobMgr = c
-    return jobMgr
+    return JobManager.registry.get(jobMgrType)
 
 
 def getAvailableJobManagerTypes():
@@ -883,8 +1287,7 @@ def getAvailableJobManagerTypes():
     """
     rioserrors.deprecationWarning("The JobManager class is deprecated (v2.0.0)")
 
-    subClasses = JobManager.__subclasses__()
-    typeList = [c.jobMgrType for c in subClasses]
+    typeList = list(JobManager.registry)
     return typeList
 
 
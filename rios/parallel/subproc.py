@@ -29,10 +29,26 @@ This file is entirely deprecated (as of version 2.0.0).
 from __future__ import print_function
 
 import os
+import sys
+import mmap
+import struct
+import pickle
+
 try:
-    import cPickle as pickle
+    import zstandard
 except ImportError:
-    import pickle
+    zstandard = None
+
+PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL
+# Frames smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 64 * 1024
+# The stream starts with a flag saying whether compression was requested,
+# and the number of out-of-band buffers
+STREAM_HDR_FMT = '<?I'
+STREAM_HDR_SIZE = struct.calcsize(STREAM_HDR_FMT)
+# Each frame starts with a compression flag, and the length of its data
+FRAME_HDR_FMT = '<?Q'
+FRAME_HDR_SIZE = struct.calcsize(FRAME_HDR_FMT)
 
 
 def runJob(inf, outf, inFileName=None):
@@ -44,8 +60,11 @@ def runJob(inf, outf, inFileName=None):
     will be deleted once it is read from.
     """
 
-    # Read the pickled input
-    (fn, jobInfo) = pickle.load(inf)
+    # Read the pickled input. The output is compressed only if the input was. 
+    ((fn, jobInfo), compress) = loadStream(inf)
+    # The function may have been pickled separately, once for all jobs
+    if isinstance(fn, (bytes, bytearray)):
+        fn = pickle.loads(fn)
     
     # If using a disk file for input, close it and remove it now that we have read it
     if inFileName is not None:
@@ -60,4 +79,211 @@ def runJob(inf, outf, inFileName=None):
     outputs = jobInfo.getFunctionResult(params)
     
     # Pickle and write out the output
-    pickle.dump(outputs, outf)
+    dumpWithBuffers(outputs, outf, compress=compress)
+    outf.flush()
+
+
+def dumpWithBuffers(obj, outf, dumps=pickle.dumps, compress=False):
+    """
+    Pickle the given object, writing it to the open file outf. 
+    With pickle protocol 5 or later, large buffers such as the 
+    data of numpy arrays are written out-of-band, as separate frames 
+    after the main pickle, rather than being copied into the pickle 
+    stream. Read it back with loadWithBuffers(). 
+
+    The dumps argument allows a different pickler (e.g. cloudpickle.dumps)
+    to be used for the main pickle. It must accept the protocol and
+    buffer_callback arguments, as pickle.dumps does. 
+
+    If compress is True, each frame of at least MIN_COMPRESS_SIZE bytes 
+    is compressed, using the zstandard package. This must then be 
+    available to whoever reads it back. Whether compression was requested
+    is recorded at the start of the stream, so the reader can do the same
+    with anything it sends back. 
+    """
+    chunks = dumpToChunks(obj, dumps, compress)
+    writeChunks(outf, chunks)
+
+
+def dumpToChunks(obj, dumps=pickle.dumps, compress=False,
+        copyBuffers=False):
+    """
+    Pickle the given object as for dumpWithBuffers(), but rather than
+    writing it out, return the list of bytes-like chunks which make up
+    the stream, for writeChunks() to write later. 
+    
+    Uncompressed out-of-band buffers are views of the memory of the original 
+    object (e.g. its numpy arrays). If copyBuffers is True, they are copied, 
+    so the chunks are a snapshot of the object, which is not affected by 
+    any later changes to it. 
+    """
+    buffers = []
+    header = pickleDumps(obj, dumps, buffers)
+
+    # Compressor objects are not thread-safe, so make one for each call
+    compressor = None
+    if compress:
+        if zstandard is None:
+            msg = "Compressed pickles requested, but zstandard is unavailable"
+            raise ImportError(msg)
+        compressor = zstandard.ZstdCompressor(level=1)
+
+    chunks = [struct.pack(STREAM_HDR_FMT, compress, len(buffers))]
+    chunks.extend(makeFrame(header, compressor))
+    for buf in buffers:
+        (frameHdr, data) = makeFrame(buf.raw(), compressor)
+        if copyBuffers and isinstance(data, memoryview):
+            # Not compressed, so still a view of the original
+            data = bytes(data)
+        chunks.extend([frameHdr, data])
+    return chunks
+
+
+def writeChunks(outf, chunks):
+    """
+    Write the list of chunks from dumpToChunks() to the open file outf
+    """
+    for chunk in chunks:
+        outf.write(chunk)
+
+
+def pickleDumps(obj, dumps, buffers):
+    """
+    Pickle obj using the given dumps function, appending any out-of-band
+    buffers to the list buffers. Returns the main pickle. 
+    """
+    if PICKLE_PROTOCOL >= 5:
+        header = dumps(obj, protocol=PICKLE_PROTOCOL,
+            buffer_callback=buffers.append)
+    else:
+        header = dumps(obj, protocol=PICKLE_PROTOCOL)
+    return header
+
+
+def makeFrame(data, compressor):
+    """
+    Return one frame of data, as a tuple of its header (the compression 
+    flag and length) and the data itself. The data is compressed if a 
+    compressor is given, and the data is large enough to be worth it. 
+    """
+    compressed = (compressor is not None and len(data) >= MIN_COMPRESS_SIZE)
+    if compressed:
+        data = compressor.compress(data)
+    return (struct.pack(FRAME_HDR_FMT, compressed, len(data)), data)
+
+
+def loadWithBuffers(inf):
+    """
+    Read an object written by dumpWithBuffers() from the open file inf,
+    and return the unpickled object. 
+    """
+    (obj, compress) = loadStream(inf)
+    return obj
+
+
+def loadStream(inf):
+    """
+    Read an object written by dumpWithBuffers() from the open file inf. 
+    Returns a tuple of the unpickled object, and whether the writer 
+    requested compression. 
+    """
+    (compress, numBuffers) = struct.unpack(STREAM_HDR_FMT,
+        readExactly(inf, STREAM_HDR_SIZE))
+    header = readFrame(inf)
+    if numBuffers == 0:
+        obj = pickle.loads(header)
+    else:
+        buffers = [readFrame(inf) for i in range(numBuffers)]
+        obj = pickle.loads(header, buffers=buffers)
+    return (obj, compress)
+
+
+def readFrame(inf):
+    """
+    Read one frame made by makeFrame() from the open file inf, 
+    and return its (uncompressed) data as a bytearray
+    """
+    (compressed, dataLen) = struct.unpack(FRAME_HDR_FMT,
+        readExactly(inf, FRAME_HDR_SIZE))
+    data = readExactly(inf, dataLen)
+    if compressed:
+        data = decompress(data)
+    return data
+
+
+def loadFileWithBuffers(filename):
+    """
+    Read an object written by dumpWithBuffers() to the given file, and
+    return the unpickled object. 
+    
+    The file is memory-mapped (copy-on-write), and any uncompressed 
+    out-of-band buffers are handed to the unpickler as views of the 
+    mapping, so large arrays are not read into a separate copy first. 
+    The mapping stays alive for as long as the arrays which use it, 
+    even if the file is then removed. 
+    
+    On Windows, a file cannot be removed while it is mapped, and the
+    caller normally removes it straight away. So there, the file is 
+    instead read into ordinary memory, as for loadWithBuffers(), and 
+    closed before returning. 
+    """
+    if sys.platform == 'win32':
+        with open(filename, 'rb') as f:
+            return loadWithBuffers(f)
+
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise EOFError("Empty pickle file {}".format(filename))
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    view = memoryview(mm)
+
+    if len(view) < STREAM_HDR_SIZE:
+        raise EOFError("Unexpected end of pickled data in {}".format(filename))
+    (compress, numBuffers) = struct.unpack_from(STREAM_HDR_FMT, view, 0)
+    pos = STREAM_HDR_SIZE
+    frames = []
+    for i in range(numBuffers + 1):
+        if pos + FRAME_HDR_SIZE > len(view):
+            raise EOFError("Unexpected end of pickled data in {}".format(filename))
+        (compressed, dataLen) = struct.unpack_from(FRAME_HDR_FMT, view, pos)
+        pos += FRAME_HDR_SIZE
+        if pos + dataLen > len(view):
+            raise EOFError("Unexpected end of pickled data in {}".format(filename))
+        data = view[pos:pos + dataLen]
+        pos += dataLen
+        if compressed:
+            data = decompress(data)
+        frames.append(data)
+
+    if numBuffers == 0:
+        obj = pickle.loads(frames[0])
+    else:
+        obj = pickle.loads(frames[0], buffers=frames[1:])
+    return obj
+
+
+def decompress(data):
+    """
+    Decompress a frame compressed by makeFrame(), returning a bytearray
+    """
+    if zstandard is None:
+        msg = "Pickled data is compressed, but zstandard is unavailable"
+        raise ImportError(msg)
+    return bytearray(zstandard.ZstdDecompressor().decompress(data))
+
+
+def readExactly(inf, numBytes):
+    """
+    Read exactly numBytes from the open file inf, into a new bytearray.
+    A bytearray is used so that any numpy arrays built on top of it
+    are writeable. Raises EOFError if the file ends too soon. 
+    """
+    buf = bytearray(numBytes)
+    view = memoryview(buf)
+    pos = 0
+    while pos < numBytes:
+        n = inf.readinto(view[pos:])
+        if not n:
+            raise EOFError("Unexpected end of pickled data")
+        pos += n
+    return buf
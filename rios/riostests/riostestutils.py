@@ -308,6 +308,21 @@ def testAll():
     if not ok:
         failureCount += 1
 
+    from . import testimagewriter
+    ok = testimagewriter.run()
+    if not ok:
+        failureCount += 1
+
+    from . import testpicklestream
+    ok = testpicklestream.run()
+    if not ok:
+        failureCount += 1
+
+    from . import testjobmanager
+    ok = testjobmanager.run()
+    if not ok:
+        failureCount += 1
+
     from . import testavgthreads
     ok = testavgthreads.run()
     if not ok:
@@ -0,0 +1,249 @@
+"""
+Test the row batching of the old ImageWriter class, i.e. the
+writebatchrows argument, and closing in the background.
+
+Writes a known array, one block at a time, with a block size which does
+not divide evenly into the image, so the last block of each row, and the
+last row of blocks, are only partial. This is done with batches of a few
+different sizes, including ones which leave a partial batch to be written
+by close(), and the file contents are checked against the original array.
+
+The same is done for a GTiff file with INTERLEAVE=PIXEL, which is
+written with all bands of a block in a single call.
+
+Several files are then closed with close(background=True), and checked
+after waitOnBackgroundClose(). A background close which fails must have
+its exception re-raised by waitOnBackgroundClose(). 
+
+"""
+# This file is part of RIOS - Raster I/O Simplification
+# Copyright (C) 2012  Sam Gillingham, Neil Flood
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import print_function
+import os
+
+import numpy
+from osgeo import gdal
+from osgeo import osr
+
+from rios import imagewriter
+from rios.imagewriter import ImageWriter
+from rios.cuiprogress import SilentProgress
+from . import riostestutils
+
+TESTNAME = "TESTIMAGEWRITER"
+
+NROWS = 230
+NCOLS = 250
+NBANDS = 2
+BLOCKSIZE = 100
+
+
+def run():
+    """
+    Run the test
+    """
+    riostestutils.reportStart(TESTNAME)
+
+    outfile = 'imagewriter.img'
+    imgArr = genTestArray()
+
+    ok = True
+    try:
+        # With 3 rows of blocks, a batch of 2 rows leaves the last row
+        # for close(), and a batch of 5 leaves everything for close().
+        for writebatchrows in [None, 1, 2, 5]:
+            writer = writeBlocks(imgArr, outfile, writebatchrows)
+            writer.close()
+            context = "writebatchrows={}".format(writebatchrows)
+            if not checkResult(imgArr, outfile, context):
+                ok = False
+    finally:
+        if os.path.exists(outfile):
+            riostestutils.removeRasterFile(outfile)
+
+    if not testPixelInterleaved(imgArr):
+        ok = False
+
+    if not testBackgroundClose(imgArr):
+        ok = False
+
+    if ok:
+        riostestutils.report(TESTNAME, "Passed")
+
+    return ok
+
+
+def genTestArray():
+    """
+    Make an array of distinct values, so that any block written
+    in the wrong place will show up
+    """
+    numPix = NBANDS * NROWS * NCOLS
+    imgArr = numpy.arange(numPix, dtype=numpy.int32).reshape(
+        (NBANDS, NROWS, NCOLS))
+    return imgArr
+
+
+def writeBlocks(imgArr, outfile, writebatchrows, drivername='HFA',
+        creationoptions=None):
+    """
+    Write the given array to outfile, one block at a time, in the
+    same order as ImageReader would give them. Returns the ImageWriter, 
+    which has not yet been closed. 
+    """
+    transform = (riostestutils.DEFAULT_XLEFT, riostestutils.DEFAULT_PIXSIZE, 0,
+        riostestutils.DEFAULT_YTOP, 0, -riostestutils.DEFAULT_PIXSIZE)
+    sr = osr.SpatialReference()
+    sr.ImportFromEPSG(riostestutils.DEFAULT_EPSG)
+    projection = sr.ExportToWkt()
+
+    writer = ImageWriter(outfile, drivername=drivername,
+        creationoptions=creationoptions, nbands=NBANDS,
+        gdaldatatype=gdal.GDT_Int32, xsize=NCOLS, ysize=NROWS,
+        transform=transform, projection=projection, windowxsize=BLOCKSIZE,
+        windowysize=BLOCKSIZE, overlap=0, writebatchrows=writebatchrows)
+    block = numpy.zeros((NBANDS, BLOCKSIZE, BLOCKSIZE), dtype=imgArr.dtype)
+    for top in range(0, NROWS, BLOCKSIZE):
+        for left in range(0, NCOLS, BLOCKSIZE):
+            blockArr = imgArr[:, top:top + BLOCKSIZE, left:left + BLOCKSIZE]
+            # Re-use the same array for every full block, as a caller may do
+            if blockArr.shape == block.shape:
+                block[:] = blockArr
+                writer.write(block)
+            else:
+                writer.write(blockArr.copy())
+    return writer
+
+
+def testPixelInterleaved(imgArr):
+    """
+    Write a pixel-interleaved GTiff file, with and without row batching,
+    and check its contents
+    """
+    outfile = 'imagewriter.tif'
+    creationoptions = ['TILED=YES', 'INTERLEAVE=PIXEL']
+
+    ok = True
+    try:
+        for writebatchrows in [None, 2]:
+            writer = writeBlocks(imgArr, outfile, writebatchrows,
+                drivername='GTiff', creationoptions=creationoptions)
+            pixelInterleaved = writer.pixelInterleaved
+            writer.close()
+            context = "GTiff INTERLEAVE=PIXEL, writebatchrows={}".format(
+                writebatchrows)
+            if not pixelInterleaved:
+                msg = "{}: not written as pixel-interleaved".format(context)
+                riostestutils.report(TESTNAME, msg)
+                ok = False
+            if not checkResult(imgArr, outfile, context):
+                ok = False
+    finally:
+        if os.path.exists(outfile):
+            riostestutils.removeRasterFile(outfile)
+
+    return ok
+
+
+def testBackgroundClose(imgArr):
+    """
+    Close several files in the background, with statistics and pyramids,
+    and check them once waitOnBackgroundClose() has returned. Then check 
+    that the exception from a failing background close is re-raised. 
+    """
+    outfileList = ['imagewriter_bg{}.img'.format(i) for i in range(3)]
+    failfile = 'imagewriter_bgfail.img'
+
+    ok = True
+    try:
+        for outfile in outfileList:
+            writer = writeBlocks(imgArr, outfile, None)
+            writer.close(calcStats=True, background=True)
+        imagewriter.waitOnBackgroundClose()
+        for outfile in outfileList:
+            context = "background close of {}".format(outfile)
+            if not checkResult(imgArr, outfile, context, checkStats=True):
+                ok = False
+
+        writer = writeBlocks(imgArr, failfile, None)
+        writer.close(calcStats=True, progress=FailingProgress(),
+            background=True)
+        try:
+            imagewriter.waitOnBackgroundClose()
+            msg = "Exception from background close was not re-raised"
+            riostestutils.report(TESTNAME, msg)
+            ok = False
+        except BackgroundCloseTestError:
+            pass
+        # The failed close leaves the file open, so close it here
+        del writer
+    finally:
+        for outfile in outfileList + [failfile]:
+            if os.path.exists(outfile):
+                riostestutils.removeRasterFile(outfile)
+
+    return ok
+
+
+class BackgroundCloseTestError(Exception):
+    "Raised by FailingProgress"
+
+
+class FailingProgress(SilentProgress):
+    """
+    Progress object which raises an exception as soon as it is used,
+    to make close() fail
+    """
+    def setLabelText(self, text):
+        raise BackgroundCloseTestError("Deliberate failure in close()")
+
+    def setProgress(self, progress):
+        raise BackgroundCloseTestError("Deliberate failure in close()")
+
+
+def checkResult(imgArr, outfile, context, checkStats=False):
+    """
+    Check that the file contains the given array. If checkStats is True,
+    also check that every band has statistics. The context string is 
+    used in any messages. 
+    """
+    ds = gdal.Open(outfile)
+    fileArr = ds.ReadAsArray()
+    bandsWithoutStats = [i + 1 for i in range(ds.RasterCount)
+        if ds.GetRasterBand(i + 1).GetMetadataItem('STATISTICS_MAXIMUM') is None]
+    del ds
+
+    ok = True
+    if fileArr.shape != imgArr.shape:
+        msg = "{}: shape mis-match {} != {}".format(context, fileArr.shape,
+            imgArr.shape)
+        riostestutils.report(TESTNAME, msg)
+        ok = False
+    elif (fileArr != imgArr).any():
+        numWrong = numpy.count_nonzero(fileArr != imgArr)
+        msg = "{}: {} pixels incorrect".format(context, numWrong)
+        riostestutils.report(TESTNAME, msg)
+        ok = False
+    elif checkStats and len(bandsWithoutStats) > 0:
+        msg = "{}: no statistics on bands {}".format(context, bandsWithoutStats)
+        riostestutils.report(TESTNAME, msg)
+        ok = False
+
+    return ok
+
+
+if __name__ == "__main__":
+    run()
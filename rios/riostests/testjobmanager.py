@@ -0,0 +1,282 @@
+"""
+Test parts of the old (deprecated) JobManager classes, which can be
+exercised without running any sub-jobs.
+
+Checks the registry of JobManager sub-classes. A sub-class which does
+not set its own jobMgrType must not replace the class it inherits it
+from, while one which does set it must be found by that name.
+
+Checks the QstatPoller, used by the PbsJobManager, with a fake qstat
+command put on the PATH, which reports jobs from a state file controlled
+by the test. Several waiters must each return as soon as their own jobs
+have finished. When qstat fails, each waiter must get the error, and the
+polling thread must exit. Skipped on Windows, where the fake qstat
+cannot be run directly.
+
+"""
+# This file is part of RIOS - Raster I/O Simplification
+# Copyright (C) 2012  Sam Gillingham, Neil Flood
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+
+from rios import rioserrors
+from rios.parallel import jobmanager
+from . import riostestutils
+
+TESTNAME = "TESTJOBMANAGER"
+
+# A jobMgrType which no real JobManager uses
+TEST_JOBMGRTYPE = 'riostest_jobmgr'
+
+# The fake qstat. Reports the jobs listed in the state file, one
+# "jobID state" per line, and complains about any others, as the real
+# qstat does. If the fail file exists, it fails as though it could not
+# reach the PBS server.
+FAKE_QSTAT = """#!{python}
+import os
+import sys
+
+stateDir = os.path.dirname(os.path.abspath(__file__))
+if os.path.exists(os.path.join(stateDir, 'qstat_fail')):
+    sys.stderr.write("qstat: cannot connect to server pbs01 (errno=111)\\n")
+    sys.exit(2)
+
+with open(os.path.join(stateDir, 'qstat_state')) as f:
+    states = dict(line.split() for line in f if len(line.strip()) > 0)
+
+print("Job id            Name             User              Time Use S Queue")
+print("----------------  ---------------- ----------------  -------- - -----")
+exitStatus = 0
+for jobID in sys.argv[1:]:
+    if jobID in states:
+        print("{{}} testjob riostest 00:00:01 {{}} workq".format(jobID,
+            states[jobID]))
+    else:
+        sys.stderr.write("qstat: Unknown Job Id {{}}\\n".format(jobID))
+        exitStatus = 153
+sys.exit(exitStatus)
+"""
+
+# Longest time to wait for something which should happen promptly
+TIMEOUT = 10
+
+
+def run():
+    """
+    Run the test
+    """
+    riostestutils.reportStart(TESTNAME)
+
+    ok = testRegistry()
+
+    if riostestutils.platformName == "Windows":
+        riostestutils.report(TESTNAME, "Skipped QstatPoller test on Windows")
+    elif not testQstatPoller():
+        ok = False
+
+    if ok:
+        riostestutils.report(TESTNAME, "Passed")
+
+    return ok
+
+
+def testRegistry():
+    """
+    Check that sub-classing a registered JobManager does not replace it,
+    unless the sub-class sets its own jobMgrType
+    """
+    ok = True
+    try:
+        class InheritedTypeJobManager(jobmanager.SubprocJobManager):
+            "Inherits jobMgrType from SubprocJobManager"
+
+        class OwnTypeJobManager(jobmanager.SubprocJobManager):
+            "Sets its own jobMgrType"
+            jobMgrType = TEST_JOBMGRTYPE
+
+        subprocClass = jobmanager.getJobManagerClassByType('subproc')
+        if subprocClass is not jobmanager.SubprocJobManager:
+            msg = "Type 'subproc' gives {}, not SubprocJobManager".format(
+                subprocClass.__name__)
+            riostestutils.report(TESTNAME, msg)
+            ok = False
+
+        ownTypeClass = jobmanager.getJobManagerClassByType(TEST_JOBMGRTYPE)
+        if ownTypeClass is not OwnTypeJobManager:
+            msg = "Sub-class with its own jobMgrType was not registered"
+            riostestutils.report(TESTNAME, msg)
+            ok = False
+
+        if TEST_JOBMGRTYPE not in jobmanager.getAvailableJobManagerTypes():
+            msg = "Type '{}' not listed as available".format(TEST_JOBMGRTYPE)
+            riostestutils.report(TESTNAME, msg)
+            ok = False
+    finally:
+        # Do not leave the test class registered
+        jobmanager.JobManager.registry.pop(TEST_JOBMGRTYPE, None)
+
+    return ok
+
+
+class FakeQstat(object):
+    """
+    Put the fake qstat command on the PATH, in a temporary directory,
+    with its state file. Use as a context manager. 
+    """
+    def __enter__(self):
+        self.tempdir = tempfile.mkdtemp(prefix='riostest_qstat')
+        qstatFile = os.path.join(self.tempdir, 'qstat')
+        with open(qstatFile, 'w') as f:
+            f.write(FAKE_QSTAT.format(python=sys.executable))
+        os.chmod(qstatFile, 0o755)
+        self.setJobs({})
+        self.origPath = os.environ['PATH']
+        os.environ['PATH'] = self.tempdir + os.pathsep + self.origPath
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        os.environ['PATH'] = self.origPath
+        shutil.rmtree(self.tempdir)
+
+    def setJobs(self, states):
+        """
+        Set the jobs which qstat reports, as a dictionary of state
+        strings, keyed by job ID
+        """
+        stateFile = os.path.join(self.tempdir, 'qstat_state')
+        tmpFile = stateFile + '.tmp'
+        with open(tmpFile, 'w') as f:
+            for (jobID, state) in states.items():
+                f.write("{} {}\n".format(jobID, state))
+        os.replace(tmpFile, stateFile)
+
+    def setFailing(self, failing):
+        """
+        Make qstat fail, or stop it failing
+        """
+        failFile = os.path.join(self.tempdir, 'qstat_fail')
+        if failing:
+            open(failFile, 'w').close()
+        elif os.path.exists(failFile):
+            os.remove(failFile)
+
+
+class PollWaiter(object):
+    """
+    Calls QstatPoller.wait() from its own thread, and records the outcome
+    """
+    def __init__(self, poller, jobIdSet):
+        self.result = None
+        self.thread = threading.Thread(target=self.wait,
+            args=(poller, jobIdSet), daemon=True)
+        self.thread.start()
+
+    def wait(self, poller, jobIdSet):
+        try:
+            poller.wait(jobIdSet)
+            self.result = 'finished'
+        except rioserrors.JobMgrError as e:
+            self.result = e
+
+    def join(self):
+        self.thread.join(timeout=TIMEOUT)
+        return self.result
+
+
+def testQstatPoller():
+    """
+    Test the QstatPoller against the fake qstat
+    """
+    ok = True
+    poller = jobmanager.QstatPoller(minInterval=0.05, maxInterval=0.2)
+    with FakeQstat() as qstat:
+        # Waiters whose jobs finish at different times
+        qstat.setJobs({'1.pbs': 'R', '2.pbs': 'R', '3.pbs': 'Q'})
+        waiterA = PollWaiter(poller, {'1.pbs'})
+        waiterB = PollWaiter(poller, {'2.pbs', '3.pbs'})
+        time.sleep(0.5)
+        if waiterA.result is not None or waiterB.result is not None:
+            riostestutils.report(TESTNAME, "Waiter returned while its jobs were running")
+            ok = False
+
+        qstat.setJobs({'2.pbs': 'R', '3.pbs': 'R'})
+        if waiterA.join() != 'finished':
+            msg = "First waiter did not finish: {}".format(waiterA.result)
+            riostestutils.report(TESTNAME, msg)
+            ok = False
+        if waiterB.result is not None:
+            riostestutils.report(TESTNAME, "Second waiter returned too soon")
+            ok = False
+
+        # A completed job may still be listed
+        qstat.setJobs({'2.pbs': 'C'})
+        if waiterB.join() != 'finished':
+            msg = "Second waiter did not finish: {}".format(waiterB.result)
+            riostestutils.report(TESTNAME, msg)
+            ok = False
+        if not pollerThreadExited(poller):
+            ok = False
+
+        # When qstat fails, every waiter gets the error
+        qstat.setJobs({'4.pbs': 'R', '5.pbs': 'R'})
+        waiterC = PollWaiter(poller, {'4.pbs'})
+        waiterD = PollWaiter(poller, {'5.pbs'})
+        time.sleep(0.3)
+        qstat.setFailing(True)
+        for waiter in [waiterC, waiterD]:
+            result = waiter.join()
+            if not isinstance(result, rioserrors.JobMgrError):
+                msg = "Waiter did not get the qstat error: {}".format(result)
+                riostestutils.report(TESTNAME, msg)
+                ok = False
+        if not pollerThreadExited(poller):
+            ok = False
+
+        # The poller can be used again once qstat works
+        qstat.setFailing(False)
+        qstat.setJobs({})
+        if PollWaiter(poller, {'6.pbs'}).join() != 'finished':
+            riostestutils.report(TESTNAME, "Poller not usable after qstat error")
+            ok = False
+
+    return ok
+
+
+def pollerThreadExited(poller):
+    """
+    Check that the poller's thread has exited, allowing a moment
+    for it to finish
+    """
+    for thread in threading.enumerate():
+        if thread.name == jobmanager.QstatPoller.threadName:
+            thread.join(timeout=TIMEOUT)
+
+    ok = True
+    running = [thread for thread in threading.enumerate()
+        if thread.name == jobmanager.QstatPoller.threadName]
+    if poller.thread is not None or len(running) > 0:
+        riostestutils.report(TESTNAME, "QstatPoller thread did not exit")
+        ok = False
+    return ok
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,215 @@
+"""
+Test the framed pickle format used to pass inputs and outputs to and from
+the sub-jobs of the old JobManager classes, i.e. dumpWithBuffers() and the
+functions which read it back, in rios.parallel.subproc.
+
+An object containing several numpy arrays is written, and read back both
+through a pipe, as the SubprocJobManager does, and from a memory-mapped
+file, as the PBS and SLURM job managers do. This is repeated with
+compression, if zstandard is available. Files truncated at various points
+are checked to raise EOFError. The arrays read from the file must 
+still be valid after the file is removed. 
+
+"""
+# This file is part of RIOS - Raster I/O Simplification
+# Copyright (C) 2012  Sam Gillingham, Neil Flood
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import print_function
+import os
+import threading
+
+import numpy
+
+from rios.parallel import subproc
+from . import riostestutils
+
+TESTNAME = "TESTPICKLESTREAM"
+
+
+def run():
+    """
+    Run the test
+    """
+    riostestutils.reportStart(TESTNAME)
+
+    picklefile = 'picklestream.tmp'
+    obj = makeTestObject()
+
+    compressList = [False]
+    if subproc.zstandard is not None:
+        compressList.append(True)
+
+    ok = True
+    try:
+        for compress in compressList:
+            with open(picklefile, 'wb') as f:
+                subproc.dumpWithBuffers(obj, f, compress=compress)
+
+            pipeObj = readThroughPipe(picklefile)
+            if not checkObject(obj, pipeObj, 'pipe', compress):
+                ok = False
+            del pipeObj
+
+            with open(picklefile, 'rb') as f:
+                streamCompress = subproc.loadStream(f)[1]
+            if streamCompress != compress:
+                msg = "Compression flag {} read back as {}".format(compress,
+                    streamCompress)
+                riostestutils.report(TESTNAME, msg)
+                ok = False
+
+            if not checkTruncated(picklefile):
+                ok = False
+
+            # Remove the file straight after reading it, as readJobOutput()
+            # does. The arrays must still be valid afterwards. 
+            fileObj = subproc.loadFileWithBuffers(picklefile)
+            os.remove(picklefile)
+            if not checkObject(obj, fileObj, 'mmap', compress):
+                ok = False
+            # Release any mapping of the file before it is re-written
+            del fileObj
+    finally:
+        if os.path.exists(picklefile):
+            os.remove(picklefile)
+
+    if ok:
+        riostestutils.report(TESTNAME, "Passed")
+
+    return ok
+
+
+def makeTestObject():
+    """
+    Make an object with a mixture of large and small arrays, as
+    out-of-band buffers, and some ordinary values which go in the
+    main pickle
+    """
+    obj = {
+        'big': numpy.arange(1000000, dtype=numpy.float64).reshape((10, 100, 1000)),
+        'ramp': riostestutils.genRampArray(),
+        'small': numpy.array([1, 2, 3], dtype=numpy.int16),
+        'name': 'someName',
+        'number': 17
+    }
+    return obj
+
+
+def readThroughPipe(picklefile):
+    """
+    Copy the contents of the given file into a pipe, from a separate
+    thread, and read the object back from the other end of the pipe
+    """
+    (readFd, writeFd) = os.pipe()
+
+    def writer():
+        with open(picklefile, 'rb') as f, os.fdopen(writeFd, 'wb') as pipeOut:
+            pipeOut.write(f.read())
+
+    writeThread = threading.Thread(target=writer)
+    writeThread.start()
+    with os.fdopen(readFd, 'rb') as pipeIn:
+        obj = subproc.loadWithBuffers(pipeIn)
+    writeThread.join()
+    return obj
+
+
+def checkObject(obj, newObj, readerName, compress):
+    """
+    Check that newObj is the same as obj, and that its arrays can be
+    written to, as the user function may modify them
+    """
+    ok = True
+    context = "{} reader, compress={}".format(readerName, compress)
+    if sorted(newObj.keys()) != sorted(obj.keys()):
+        msg = "{}: keys mis-match {} != {}".format(context,
+            sorted(newObj.keys()), sorted(obj.keys()))
+        riostestutils.report(TESTNAME, msg)
+        return False
+
+    for key in obj:
+        if isinstance(obj[key], numpy.ndarray):
+            arr = newObj[key]
+            if arr.dtype != obj[key].dtype or arr.shape != obj[key].shape:
+                msg = "{}: array '{}' has dtype {} shape {}".format(context,
+                    key, arr.dtype, arr.shape)
+                riostestutils.report(TESTNAME, msg)
+                ok = False
+            elif (arr != obj[key]).any():
+                msg = "{}: array '{}' values incorrect".format(context, key)
+                riostestutils.report(TESTNAME, msg)
+                ok = False
+            elif not arr.flags.writeable:
+                msg = "{}: array '{}' is read-only".format(context, key)
+                riostestutils.report(TESTNAME, msg)
+                ok = False
+        elif newObj[key] != obj[key]:
+            msg = "{}: value '{}' is {}, not {}".format(context, key,
+                newObj[key], obj[key])
+            riostestutils.report(TESTNAME, msg)
+            ok = False
+
+    return ok
+
+
+def checkTruncated(picklefile):
+    """
+    Check that both readers raise EOFError for the given file, when
+    cut short at various points, including within the stream header,
+    within a frame header, and within the data of the last frame
+    """
+    with open(picklefile, 'rb') as f:
+        fullData = f.read()
+
+    truncatedFile = picklefile + '.truncated'
+    headerSize = subproc.STREAM_HDR_SIZE
+    lengthList = [0, headerSize - 1, headerSize + 1,
+        len(fullData) // 2, len(fullData) - 1]
+
+    ok = True
+    try:
+        for length in lengthList:
+            with open(truncatedFile, 'wb') as f:
+                f.write(fullData[:length])
+
+            for (readerName, reader) in [('pipe', loadFromOpenFile),
+                    ('mmap', subproc.loadFileWithBuffers)]:
+                try:
+                    reader(truncatedFile)
+                    msg = "{} reader: no error for file truncated to {} bytes".format(
+                        readerName, length)
+                    riostestutils.report(TESTNAME, msg)
+                    ok = False
+                except EOFError:
+                    pass
+    finally:
+        if os.path.exists(truncatedFile):
+            os.remove(truncatedFile)
+
+    return ok
+
+
+def loadFromOpenFile(filename):
+    """
+    Read the given file with loadWithBuffers(), which reads
+    a stream, in the same way as for a pipe
+    """
+    with open(filename, 'rb') as f:
+        obj = subproc.loadWithBuffers(f)
+    return obj
+
+
+if __name__ == "__main__":
+    run()
@@ -374,8 +374,7 @@ class FilenameAssocIterator(object):
     """
     def __init__(self, infiles):
         self.fullList = []
-        for symbolicName in infiles.__dict__:
-            entry = infiles.__dict__[symbolicName]
+        for (symbolicName, entry) in infiles.__dict__.items():
             if isinstance(entry, str):
                 seqNum = None
                 self.fullList.append((symbolicName, seqNum, entry))
@@ -473,8 +472,7 @@ class BlockAssociations:
 
     def __len__(self):
         count = 0
-        for symbolicName in self.__dict__:
-            entry = self.__dict__[symbolicName]
+        for entry in self.__dict__.values():
             if isinstance(entry, list):
                 count += len(entry)
             else: